@@ -1,12 +1,33 @@
+import math
 import secrets
 
+try:
+    # gmpy2 is optional, but its GMP-backed integers make modular exponentiation noticeably faster
+    # results are converted back to int when they leave the arithmetic helpers, since older versions of gmpy2's mpz
+    # lack some int methods, like to_bytes()
+    from gmpy2 import mpz, powmod, powmod_sec
+    from gmpy2 import next_prime as gmpy2_next_prime
+    GMPY2_AVAILABLE = True
+except ImportError:
+    mpz = int
+    powmod = pow
+    GMPY2_AVAILABLE = False
+
+# the first 100 primes, used to cheaply rule out most composites before running Miller-Rabin
+SMALL_PRIMES = tuple(i for i in range(2, 542) if all(i % j != 0 for j in range(2, math.isqrt(i) + 1)))
+SMALL_PRIMES_PRODUCT = math.prod(SMALL_PRIMES)
+
+# when set, encrypt() and decrypt() print every block they process, enabled from the command line with -p
+DEBUG = False
+
 
 def fast_exponent_mod(base, exponent, modulus):
     """
     An efficient implementation of fast exponentiation modulo n.
 
-    This implementation comes from Introduction to Algorithms by Cormen, Leiserson, Rivest, Stein, as referenced in
-    Professor Kabir's lecture notes.
+    This originally implemented the CLRS square-and-multiply algorithm from Introduction to Algorithms, as referenced
+    in Professor Kabir's lecture notes. It now defers to gmpy2's powmod() when gmpy2 is installed, or to Python's
+    built-in three-argument pow() otherwise. Both perform the same algorithm in C using a windowed exponentiation.
 
     :param base: Integer - The base
     :param exponent: Integer - The exponent
@@ -14,44 +35,109 @@ def fast_exponent_mod(base, exponent, modulus):
     :return: Integer - The result of the exponentiation
     """
 
-    c = 0
-    d = 1
-    binary_exp = format(exponent, 'b')
+    return int(powmod(base, exponent, modulus))
+
 
-    for bit in binary_exp:
-        c = 2 * c
-        d = (d * d) % modulus
-        if bit == '1':
-            c += 1
-            d = (d * base) % modulus
+def constant_time_exponent_mod(base, exponent, modulus):
+    """
+    Fast exponentiation modulo n, for use when the exponent is secret.
 
-    return d
+    fast_exponent_mod() does more work for 1 bits than for 0 bits, so its running time can leak the exponent. This
+    uses gmpy2's powmod_sec() when gmpy2 is installed. Otherwise it uses a Montgomery ladder, which always runs for
+    the full bit length of the modulus and does the same two multiplications for every bit, selecting between them
+    with masks rather than branches. Python integers are not truly constant time, but this removes the branches and
+    loop counts that depend on the exponent.
 
+    :param base: Integer - The base
+    :param exponent: Integer - The secret exponent, 0 <= exponent < modulus
+    :param modulus: Integer - The modulus, should be odd
+    :return: Integer - The result of the exponentiation
+    """
 
-def miller_rabin(n, s):
+    if GMPY2_AVAILABLE:
+        # powmod_sec() rejects a zero exponent
+        return int(powmod_sec(base, exponent, modulus)) if exponent > 0 else 1 % modulus
+
+    # invariant: r1 = r0 * base
+    r0 = 1
+    r1 = base % modulus
+    for i in range(modulus.bit_length() - 1, -1, -1):
+        # mask is all ones when the bit is set, and zero otherwise
+        mask = -((exponent >> i) & 1)
+        # swap r0 and r1 when the bit is set, so that the same multiplications cover both cases
+        swap = (r0 ^ r1) & mask
+        r0 ^= swap
+        r1 ^= swap
+        r1 = (r0 * r1) % modulus
+        r0 = (r0 * r0) % modulus
+        swap = (r0 ^ r1) & mask
+        r0 ^= swap
+        r1 ^= swap
+    return r0
+
+
+def fixed_base_exponent_mod(base, modulus):
+    """
+    Prepares fast exponentiation modulo n for a base that will be raised to many different exponents.
+
+    Without gmpy2, this precomputes a table of base^(j * 16^i) mod n for every 4 bit digit j and digit position i.
+    Each exponentiation then only needs one table lookup and multiplication per 4 bits of the exponent, with no
+    squarings, which is considerably faster than pow(). gmpy2's powmod() is faster still, so it is used when available.
+
+    :param base: Integer - The base
+    :param modulus: Integer - The modulus
+    :return: Function - Takes an Integer exponent, 0 <= exponent < modulus, and returns the result of the exponentiation
+    """
+
+    if GMPY2_AVAILABLE:
+        return lambda exponent: int(powmod(base, exponent, modulus))
+
+    # row i holds base^(j * 16^i) for j = 0..15, with enough rows for any exponent below the modulus
+    table = []
+    row_base = base % modulus
+    for i in range(0, (modulus.bit_length() + 3) // 4):
+        row = [1]
+        for j in range(1, 16):
+            row.append((row[j - 1] * row_base) % modulus)
+        table.append(row)
+        row_base = (row[15] * row_base) % modulus
+
+    def exponent_mod(exponent):
+        result = 1
+        for row in table:
+            result = (result * row[exponent & 0xF]) % modulus
+            exponent >>= 4
+        return result
+
+    return exponent_mod
+
+
+def miller_rabin(n):
     """
     An implementation of the Miller-Rabin algorithm for primality testing.
-    This method simply generates numbers and calls 'witness()', which performs the actual test.
+    This method simply picks witnesses and calls 'witness()', which performs the actual test. Candidates sharing a
+    factor with one of the small primes are rejected up front by trial division, without running the full test.
 
-    This algorithm guarantees a composite result, but not a prime result. The confidence in a prime result goes up
-    with a higher value of s.
+    Rather than using random witnesses, the test uses the first five primes as witnesses. This set is known to give a
+    deterministic result for every n < 2,152,302,898,747, which comfortably covers the 33 bit primes used by keygen().
 
-    :param n: Integer - The number to test for primality, should be greater than 2
-    :param s: Integer - The number of random witnesses to test with
+    :param n: Integer - The number to test for primality, should be greater than 1
     :return: Boolean - True if prime, False if composite
     """
-    import random
+
+    # trial division by all of the small primes at once
+    if math.gcd(n, SMALL_PRIMES_PRODUCT) != 1:
+        return n in SMALL_PRIMES
 
     # generate t and u such that t >= 1, u is odd, and (n-1 = 2^t * u)
-    # this is done by factoring n - 1 by powers of two, using some tricks with binary
-    u = n - 1
-    t = 0
-    while (u & 0b1) != 1:
-        u //= 2
-        t += 1
-
-    for i in range(0, s):
-        a = random.randrange(2, n - 1)
+    # this is done by factoring n - 1 by powers of two, using some tricks with binary:
+    # m & -m isolates the lowest set bit of m, whose position is the number of trailing zeros
+    n = mpz(n)
+    m = n - 1
+    t = (m & -m).bit_length() - 1
+    u = m >> t
+
+    for a in (2, 3, 5, 7, 11):
         if witness(a, n, t, u):
             return False
     return True
@@ -71,22 +157,45 @@ def witness(a, n, t, u):
     """
 
     # Wikipedia's Algorithm:
-    x = fast_exponent_mod(a, u, n)
-    if x == 1 or x == (n - 1):
+    n_minus_1 = n - 1
+    x = powmod(a, u, n)
+    if x == 1 or x == n_minus_1:
         return False
     for i in range(0, t - 1):
-        x = fast_exponent_mod(x, 2, n)
-        if x == n - 1:
+        # a plain multiply and reduce is cheaper than a full powmod() call for a single squaring
+        x = x * x % n
+        if x == n_minus_1:
             return False
     return True
 
 
+def next_prime(n):
+    """
+    Finds the smallest prime greater than n.
+
+    When gmpy2 is installed, this uses GMP's next_prime(), which sieves and tests candidates in C. Otherwise, odd
+    candidates are checked one at a time with 'miller_rabin()'.
+
+    :param n: Integer - The starting point of the search
+    :return: Integer - The first prime after n
+    """
+
+    if GMPY2_AVAILABLE:
+        return int(gmpy2_next_prime(n))
+
+    n = (n + 1) | 1  # the first odd number after n
+    while not miller_rabin(n):
+        n += 2
+    return n
+
+
 def keygen():
     """
     Generates a random public and private key.
     Each key contains the selected prime, a generator for the prime, and a unique integer.
 
-    The public and private keys are stored in 'pubkey.txt' and 'prikey.txt' respectively.
+    The public and private keys are stored in 'pubkey.txt' and 'prikey.txt' respectively, in the binary format
+    described by 'write_key()'.
 
     :return: The public and private keys, each as a 3-part tuple containing the prime, generator, and key.
     """
@@ -96,142 +205,156 @@ def keygen():
 
     # find prime 'p'
     while True:
-        while True:
-            q = secrets.randbits(32)
-            q = q | 2147483649  # ensure that 32nd bit is high and the number is odd
-            if miller_rabin(q, 100) and q % 12 == 5:
-                break
+        # start from a random number with the 32nd bit high, and take the next prime after it
+        q = next_prime(secrets.randbits(32) | 2147483649)
+        if q % 12 != 5 or q.bit_length() != 32:
+            continue
         p = (2 * q) + 1
-        if miller_rabin(p, 100):
+        if miller_rabin(p):
             break
 
     # pick a random secret key 'd'
     d = secrets.randbelow(p)
 
     # calculate public key 'e2'
-    e2 = fast_exponent_mod(g, d, p)
+    e2 = int(fast_exponent_mod(g, d, p))
 
-    with open('pubkey.txt', 'w') as file:
-        file.write(str(p) + ' ' + str(g) + ' ' + str(e2))
-
-    with open('prikey.txt', 'w') as file:
-        file.write(str(p) + ' ' + str(g) + ' ' + str(d))
+    write_key('pubkey.txt', p, g, e2)
+    write_key('prikey.txt', p, g, d)
 
     return (p, g, e2), (p, g, d)
 
 
+def block_size(p):
+    """
+    A helper method for the key and cipher text file formats
+    Finds the number of bytes needed to store any integer less than p
+
+    :param p: Integer - The prime from the key
+    :return: Integer - The size in bytes of each stored integer
+    """
+    return (p.bit_length() + 7) // 8
+
+
+def write_key(key_file, p, g, key):
+    """
+    A helper method for keygen()
+    Writes a key as the three big-endian integers p, g, and key, each 'block_size(p)' bytes wide
+
+    :param key_file: The name of the file to write
+    :param p: Integer - The prime
+    :param g: Integer - The generator
+    :param key: Integer - The public or private key
+    :return: Nothing
+    """
+    size = block_size(p)
+    with open(key_file, 'wb') as file:
+        file.write(p.to_bytes(size, 'big') + g.to_bytes(size, 'big') + key.to_bytes(size, 'big'))
+
+
+def read_key(key_file):
+    """
+    A helper method for encrypt() and decrypt()
+    Reads a key written by write_key()
+
+    :param key_file: The name of the file to read
+    :return: The prime, generator, and key as a 3-part tuple
+    """
+    with open(key_file, 'rb') as file:
+        data = file.read()
+    size = len(data) // 3
+    p = int.from_bytes(data[:size], 'big')
+    g = int.from_bytes(data[size:2 * size], 'big')
+    key = int.from_bytes(data[2 * size:], 'big')
+    return p, g, key
+
+
 def encrypt(key_file, text_file):
     """
     Encrypts an ASCII text file using a public key generated from keygen()
-    The resulting cipher text is written to a file called 'ctext.txt'
+    The resulting cipher text is written to a file called 'ctext.txt', as a series of (c1, c2) pairs, with each
+    integer stored big-endian in 'block_size(p)' bytes
 
-    :param key_file: A text file containing the public key in the form 'p g e2'
+    :param key_file: A key file containing the public key (p, g, e2)
     :param text_file: An ASCII text file containing a plaintext message to encrypt
     :return: Nothing
     """
     # read in public key from key_file
-    with open(key_file, 'r') as file:
-        key = file.read().split(' ')
-        p = int(key[0])
-        g = int(key[1])
-        e2 = int(key[2])
-
-    with open(text_file, 'r') as message_file:
-        with open('ctext.txt', 'w') as cipher_file:
-            while True:
-                m, eof = getblock(message_file)
-                k = secrets.randbelow(p)
-                c1 = fast_exponent_mod(g, k, p)
-                c2 = (fast_exponent_mod(e2, k, p) * (m % p)) % p
-                print("C1 C2:", c1, c2)
-                cipher_file.write(str(c1) + ' ' + str(c2) + ' ')
-
-                if eof:
-                    break
-
-
-def getblock(file):
-    """
-    A helper method for encrypt()
-    Reads a 32 bit block from a given ASCII text file
+    p, g, e2 = read_key(key_file)
 
-    :param file: The file to read
-    :return: A 32 bit integer block, and EOF status
-    """
-    eof = False
-    block = 0
+    with open(text_file, 'rb') as message_file:
+        message = message_file.read()
+
+    # pad the message with '0' characters to fill out the last 32 bit block
+    # a message that already ends on a block boundary gets one extra block of padding
+    message += b'0' * (4 - len(message) % 4)
+
+    # g and e2 are raised to a new random power for every block, so prepare them once up front
+    g_exponent_mod = fixed_base_exponent_mod(g, p)
+    e2_exponent_mod = fixed_base_exponent_mod(e2, p)
 
-    for i in range(4):
-        char = file.read(1)
-        if char == '':
-            char = '0'
-            eof = True
-        block = (block << 8) ^ ord(char)
-    return block, eof
+    # collect the cipher text in memory so that it can be written out all at once
+    size = block_size(p)
+    cipher_text = bytearray()
+    for i in range(0, len(message), 4):
+        m = int.from_bytes(message[i:i + 4], 'big')
+        k = secrets.randbelow(p)
+        c1 = int(g_exponent_mod(k))
+        c2 = int((e2_exponent_mod(k) * (m % p)) % p)
+        if DEBUG:
+            print("C1 C2:", c1, c2)
+        cipher_text.extend(c1.to_bytes(size, 'big'))
+        cipher_text.extend(c2.to_bytes(size, 'big'))
+
+    with open('ctext.txt', 'wb') as cipher_file:
+        cipher_file.write(cipher_text)
 
 
 def decrypt(key_file, cipher_file):
     """
     Decrypts a cipher text file created with encrypt(), using a private key generated with keygen()
-    The file is assumed to be an ASCII text file containing a series of integers separated by spaces
+    The file is assumed to contain a series of (c1, c2) pairs, in the format written by encrypt()
 
     The resulting plaintext is written to a file called 'dtext.txt'
 
-    :param key_file: A text file containing the public key in the form 'p g d'
-    :param cipher_file: An ASCII text file containing the cipher text to decrypt
+    :param key_file: A key file containing the private key (p, g, d)
+    :param cipher_file: A file containing the cipher text to decrypt
     :return: Nothing
     """
     # read in private key from key_file
-    with open(key_file, 'r') as file:
-        key = file.read().split(' ')
-        p = int(key[0])
-        g = int(key[1])  # the generator isn't actually needed for decryption
-        d = int(key[2])
-
-    with open(cipher_file, 'r') as cipher_file:
-        with open('dtext.txt', 'w') as decryption_file:
-            while True:
-                c1, eof = readint(cipher_file)
-                c2, eof = readint(cipher_file)
-                if eof:
-                    break
-                m = (fast_exponent_mod(c1, p - 1 - d, p) * (c2 % p)) % p
-                # convert integer message block to ASCII characters
-                m1 = (m >> 24) & 0xFF
-                m2 = (m >> 16) & 0xFF
-                m3 = (m >> 8) & 0xFF
-                m4 = m & 0xFF
-                print("Message block: " + str(m) + ' -> ' + chr(m1) + chr(m2) + chr(m3) + chr(m4))
-                decryption_file.write(chr(m1) + chr(m2) + chr(m3) + chr(m4))
-
-
-def readint(file):
-    """
-    A helper method for decrypt()
-    Reads and converts a single integer from the input file
-
-    :param file: The file to read
-    :return: A single integer and EOF status
-    """
-    eof = False
-    num = ''
-    while True:
-        # build the number one character at a time
-        nextnum = file.read(1)
-        if nextnum == ' ':
-            break
-        if nextnum == '':
-            num = 0
-            eof = True
-            break
-        num += nextnum
-    return int(num), eof
+    p, g, d = read_key(key_file)  # the generator isn't actually needed for decryption
+
+    with open(cipher_file, 'rb') as file:
+        data = file.read()
+    size = block_size(p)
+    cipher_text = [int.from_bytes(data[i:i + size], 'big') for i in range(0, len(data) - size + 1, size)]
+
+    # c1^(p-1-d) is the inverse of the shared secret c1^d, by Fermat's little theorem
+    exponent = p - 1 - d
+
+    # collect the decrypted message in memory so that it can be written out all at once
+    message = bytearray()
+    # the cipher text is a series of (c1, c2) pairs, an unpaired trailing integer is ignored
+    for i in range(0, len(cipher_text) - 1, 2):
+        c1 = cipher_text[i]
+        c2 = cipher_text[i + 1]
+        m = int((constant_time_exponent_mod(c1, exponent, p) * c2) % p)
+        # convert integer message block to its 4 characters
+        # mask to 32 bits, since a mismatched key can produce blocks up to p
+        block = (m & 0xFFFFFFFF).to_bytes(4, 'big')
+        if DEBUG:
+            print("Message block: " + str(m) + ' -> ' + block.decode('latin-1'))
+        message.extend(block)
+
+    with open('dtext.txt', 'wb') as decryption_file:
+        decryption_file.write(message)
 
 
 if __name__ == '__main__':
     import argparse
 
-    parser = argparse.ArgumentParser(usage='public-key-cryptosystem.py [-h] ("keygen" | keyfile textfile) [-e | -d]')
+    parser = argparse.ArgumentParser(
+        usage='public-key-cryptosystem.py [-h] ("keygen" | keyfile textfile) [-e | -d] [-p]')
     parser.add_argument('key_file')
     parser.add_argument('text_file', nargs='?')
     parser.add_argument('-e', action='store_true')
@@ -239,6 +362,7 @@ if __name__ == '__main__':
     parser.add_argument('-p', action='store_true')
 
     args = parser.parse_args()
+    DEBUG = args.p
 
     if args.key_file == 'keygen':
         keys = keygen()